@@ -4,10 +4,12 @@
 #
 # Contains the AutoCalibrator class that can be used to calibrate a model.
 # The class requires and HSPFModel class, start and end dates, and an output
-# location to work in while running simulations. The primary function is
-# autocalibrate, and it takes a list of HSPF variables, perturbations (as a
-# percentage, optimization parameter, and flag for parallelization as 
-# keyword arguments. The calibration routine can be summarized as follows:
+# location to work in while running simulations (optionally the simulation
+# files can be written to temporary scratch directories instead, e.g., on a
+# RAM disk such as /dev/shm). The primary function is autocalibrate, and it
+# takes a list of HSPF variables, perturbations (as a percentage, 
+# optimization parameter, and flag for parallelization as keyword 
+# arguments. The calibration routine can be summarized as follows:
 #
 #   1. Set up a series of simulations with a small perturbation to the current
 #      parameter values for the parameters of interest
@@ -19,17 +21,83 @@
 
 # The class should be adaptable to other optimization parameters.
 
-import os, pickle, datetime, time, numpy
+import os, sys, pickle, shutil, tempfile, contextlib, datetime, time
+import numpy
 
-from multiprocessing  import Pool, cpu_count
-from pyhspf.core      import HSPFModel, WDMUtil
+from multiprocessing  import cpu_count, get_context
+from multiprocessing.shared_memory import SharedMemory
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pyhspf.core      import WDMUtil
 from .calibratormodel import CalibratorModel
 
+# the state of each worker process in the parallel pool; the calibrator is
+# sent to each worker once by the initializer and the adjustments for each
+# simulation are read from a matrix in shared memory, so the tasks only need
+# to carry the row of the matrix, the name, and the perturbation
+
+_worker_state = {}
+
+def _init_worker(calibrator, name, shape):
+    """
+    Stores the calibrator and the shared matrix of adjustments in the worker
+    process. The workers are kept for the whole calibration (they are never
+    recycled), so unpickling the calibrator here is the only time a spawned
+    worker imports pyhspf.
+    """
+
+    # forked workers inherit the shared memory, spawned workers attach to it
+
+    if calibrator._memory is None: calibrator._memory = SharedMemory(name)
+
+    _worker_state['calibrator'] = calibrator
+    _worker_state['matrix']     = numpy.ndarray(shape, dtype = numpy.float64,
+                                                buffer = calibrator._memory.buf)
+
+def _simulate(task):
+    """
+    Performs a simulation with the calibrator in the worker process.
+    """
+
+    row, name, perturbation = task
+
+    adjustments = _worker_state['matrix'][row].tolist()
+
+    return _worker_state['calibrator'].simulate((name, perturbation, 
+                                                 adjustments))
+
+def _nash_sutcliffe(simulated, observed, denominator):
+    """
+    Returns the Nash-Sutcliffe efficiency for the simulated and observed
+    arrays given the sum of the squared deviations of the observations. The 
+    sum of the squared errors is a dot product to avoid a temporary array.
+    """
+
+    error = simulated - observed
+
+    return 1 - numpy.dot(error, error) / denominator
+
 class AutoCalibrator:
     """
     A class to use to autocalibrate an HSPF model.
     """
 
+    # the type of adjustment for each calibration variable (relative values
+    # are products and absolute values are sums), the lower and upper limits 
+    # on the adjusted values, and whether the IMPLNDs are also adjusted
+
+    _adjustments = {'LZSN':   ('product', None, None, False),
+                    'UZSN':   ('product', None, None, False),
+                    'LZETP':  ('product', None, None, False),
+                    'INFILT': ('product', None, None, False),
+                    'INTFW':  ('product', None, None, False),
+                    'IRC':    ('product', None, None, False),
+                    'AGWRC':  ('product', None, None, False),
+                    'KVARY':  ('sum',        0, None, False),
+                    'DEEPFR': ('sum',     None, None, False),
+                    'CCFACT': ('sum',        1,   10,  True),
+                    'MGMELT': ('sum',        0,   25,  True),
+                    }
+
     def __init__(self, 
                  hspfmodel, 
                  start, 
@@ -42,6 +110,7 @@ class AutoCalibrator:
                  hydrology = False,
                  submodel = None,
                  warmup = 30,
+                 scratch_dir = None,
                  parameter_ranges = {'IRC':    (0.5,    2),
                                      'LZETP':  (0.2,  1.5),
                                      'DEEPFR': (0,      1),
@@ -69,6 +138,51 @@ class AutoCalibrator:
         self.warmup           = warmup
         self.parameter_ranges = parameter_ranges
 
+        # location for temporary simulation files (e.g., a RAM disk such as
+        # /dev/shm); if None the files are kept in the output directory
+
+        self.scratch_dir      = scratch_dir
+
+        # pickled template model and its input WDM file for the simulations
+
+        self._hspfmodel_bytes = None
+        self._template_wdm    = None
+
+        # pool of worker processes for parallel simulations
+
+        self._executor        = None
+        self._nworkers        = None
+
+        # shared memory for the adjustments sent to the workers
+
+        self._memory          = None
+        self._matrix          = None
+
+        # values of the optimization parameter for the baseline simulations
+
+        self._baseline_cache  = {}
+
+        # indices of the calibration variables to perturb
+
+        self._active          = []
+
+        # observed flows and related values for the calibration period
+
+        self._obs_cache       = None
+
+    def __getstate__(self):
+        """
+        Excludes the pool of workers and the shared memory when sending the
+        calibrator to them.
+        """
+
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        state['_memory']   = None
+        state['_matrix']   = None
+
+        return state
+
     def create_submodel(self, 
                         filepath, 
                         name,
@@ -88,7 +202,8 @@ class AutoCalibrator:
             submodel = CalibratorModel()
             submodel.build_submodel(hspfmodel, self.comid, name = name)
 
-            with open(filepath, 'wb') as f: pickle.dump(submodel, f)
+            with open(filepath, 'wb') as f: 
+                pickle.dump(submodel, f, protocol = pickle.HIGHEST_PROTOCOL)
 
         self.submodel = filepath
 
@@ -100,10 +215,18 @@ class AutoCalibrator:
         Returns a copy of the HSPFModel.
         """
         
-        if self.submodel is None: m = self.hspfmodel
-        else:                     m = self.submodel
+        if self._hspfmodel_bytes is None:
+
+            # no template in memory, so read the model from the file
+
+            if self.submodel is None: m = self.hspfmodel
+            else:                     m = self.submodel
+
+            with open(m, 'rb') as f: hspfmodel = pickle.load(f)
 
-        with open(m, 'rb') as f: hspfmodel = pickle.load(f)
+        else:
+
+            hspfmodel = pickle.loads(self._hspfmodel_bytes)
 
         hspfmodel.filename = name
 
@@ -116,44 +239,89 @@ class AutoCalibrator:
         values relative to the default (products) or absolute values (sums).
         """ 
 
-        if variable == 'LZSN':
-            for p in model.perlnds: p.LZSN   *= adjustment
-        if variable == 'UZSN':
-            for p in model.perlnds: p.UZSN   *= adjustment
-        if variable == 'LZETP':
-            for p in model.perlnds: p.LZETP  *= adjustment
-        if variable == 'INFILT':
-            for p in model.perlnds: p.INFILT *= adjustment
-        if variable == 'INTFW':
-            for p in model.perlnds: p.INTFW  *= adjustment
-        if variable == 'IRC':
-            for p in model.perlnds: p.IRC    *= adjustment
-        if variable == 'AGWRC':
-            for p in model.perlnds: p.AGWRC  *= adjustment
-        if variable == 'KVARY':
-            for p in model.perlnds: p.KVARY  = max(0, p.KVARY + adjustment)
-        if variable == 'DEEPFR':
-            for p in model.perlnds: p.DEEPFR += adjustment
-        if variable == 'CCFACT':
-            for o in model.perlnds + model.implnds: 
-                o.CCFACT = min(10, max(1, o.CCFACT + adjustment))
-        if variable == 'MGMELT':
-            for o in model.perlnds + model.implnds: 
-                o.MGMELT = min(25, max(0, o.MGMELT + adjustment))           
-    
+        operation, lower, upper, implnds = self._adjustments[variable]
+
+        if implnds: operations = model.perlnds + model.implnds
+        else:       operations = model.perlnds
+
+        # choose the loop for the type of adjustment and limits once
+
+        if operation == 'product':
+            for o in operations: 
+                setattr(o, variable, getattr(o, variable) * adjustment)
+        elif lower is None and upper is None:
+            for o in operations: 
+                setattr(o, variable, getattr(o, variable) + adjustment)
+        elif upper is None:
+            for o in operations: 
+                setattr(o, variable, max(lower, getattr(o, variable) + 
+                                         adjustment))
+        else:
+            for o in operations: 
+                setattr(o, variable, min(upper, max(lower, 
+                                                    getattr(o, variable) +
+                                                    adjustment)))
+
+    def get_observations(self):
+        """
+        Returns the indices of the simulated daily flows that correspond to 
+        the observed flows (excluding missing data), the observed flows and
+        their logarithms, and the denominators of the Nash-Sutcliffe metrics.
+        These are the same for every simulation so they are only calculated
+        once for the calibration period.
+        """
+
+        key = self.start, self.end, self.warmup, self.comid
+
+        if self._obs_cache is not None and self._obs_cache[0] == key:
+            return self._obs_cache[1]
+
+        # the simulated flows are daily values starting after the warmup, so
+        # the position of each observation is just the number of days
+
+        n         = (self.end - self.start).days - self.warmup
+        positions = [(t - self.start).days - self.warmup for t in self.otimes]
+
+        # remove points with missing data from both simulated and oberved 
+        # flows
+
+        pairs = [(i, f) for i, f in zip(positions, self.oflows)
+                 if 0 <= i < n and f is not None]
+
+        indices = numpy.array([i for i, f in pairs], dtype = int)
+        oflows  = numpy.array([f for i, f in pairs], dtype = float)
+
+        denominator = numpy.square(oflows - oflows.mean()).sum()
+
+        # the log flows are only needed for the Nash-Sutcliffe product
+
+        if self.optimization == 'Nash-Sutcliffe Product':
+
+            log_o           = numpy.log(oflows)
+            log_denominator = numpy.square(log_o - log_o.mean()).sum()
+
+        else:
+
+            log_o, log_denominator = None, None
+
+        observations = indices, oflows, log_o, denominator, log_denominator
+
+        self._obs_cache = key, observations
+
+        return observations
+
     def run(self, 
             model,
             targets = ['reach_outvolume'],
             verbose = False,
             ):
         """
-        Creates a copy of the base model, adjusts a parameter value, runs
-        the simulation, calculates and returns the perturbation.
+        Builds the UCI file for the model (the input WDM file must already
+        exist), runs the simulation, and calculates and returns the value of 
+        the optimization parameter.
         """
 
-        # build the input files and run
-
-        model.build_wdminfile()
+        # build the UCI file and run
 
         if self.submodel is None:
 
@@ -190,31 +358,29 @@ class AutoCalibrator:
         if model.units == 'Metric': conv = 10**6
         else:                       conv = 43560
 
-        # the submodel is daily, full model is hourly
+        # the submodel is daily, full model is hourly (sum the complete days)
+
+        data = numpy.asarray(data, dtype = numpy.float64)
 
         if self.submodel is None: 
 
-            sflows = [sum(data[i:i+24]) * conv / 86400
-                      for i in range(0, len(data) - 23, 24)]
+            days  = len(data) // 24
+            daily = data[:days * 24].reshape(days, 24).sum(axis = 1)
             
         else:
 
-            sflows = [d * conv / 86400 for d in data]
+            daily = data
+
+        # get the observed flows and the corresponding simulated flows
 
-        stimes = [self.start + i * datetime.timedelta(days = 1)
-                  for i in range(self.warmup, (self.end - self.start).days)]
+        indices, oflows, log_o, denominator, log_denominator = \
+            self.get_observations()
 
-        otimes = self.otimes
-        oflows = self.oflows
+        sflows = daily[indices] * conv / 86400
 
-        # remove points with missing data from both simulated and oberved flows
+        # daily NS
 
-        sflows = [sflows[stimes.index(t)] 
-                  for t, f in zip(otimes, oflows) 
-                  if t in stimes and f is not None]
-        oflows = [oflows[otimes.index(t)] 
-                  for t, f in zip(otimes, oflows) 
-                  if f is not None]
+        dNS = _nash_sutcliffe(sflows, oflows, denominator)
 
         # return the appropriate performance metric
 
@@ -222,26 +388,14 @@ class AutoCalibrator:
 
             # daily log flows
 
-            log_o = [numpy.log(f) for f in oflows]
-            log_s = [numpy.log(f) for f in sflows]
-
-            logdNS = (1 - sum((numpy.array(log_s) - numpy.array(log_o))**2) /
-                      sum((numpy.array(log_o) - numpy.mean(log_o))**2))
-
-            # daily NS
+            log_s = numpy.log(sflows)
 
-            dNS  = (1 - sum((numpy.array(sflows) - numpy.array(oflows))**2) /
-                    sum((numpy.array(oflows) - numpy.mean(oflows))**2))
+            logdNS = _nash_sutcliffe(log_s, log_o, log_denominator)
 
             return dNS * logdNS
 
         elif self.optimization == 'Nash-Sutcliffe Efficiency': 
 
-            # daily NS
-
-            dNS  = (1 - sum((numpy.array(sflows) - numpy.array(oflows))**2) /
-                    sum((numpy.array(oflows) - numpy.mean(oflows))**2))
-
             return dNS
 
         else:
@@ -257,30 +411,84 @@ class AutoCalibrator:
 
         name, perturbation, adjustments = simulation
 
-        # create a copy of the original model to modify
+        # create a copy of the original model to modify in the output
+        # directory, or in a scratch directory that is removed after the
+        # simulation (with a short prefix to keep the paths short)
+
+        if self.scratch_dir is None: 
+            scratch = contextlib.nullcontext(self.output)
+        else:
+            scratch = tempfile.TemporaryDirectory(prefix = 'c', 
+                                                  dir = self.scratch_dir)
+
+        with scratch as directory:
+
+            filename = '{}/{}{:4.3f}'.format(directory, name, perturbation)
 
-        filename = '{}/{}{:4.3f}'.format(self.output, name, perturbation)
+            model = self.copymodel(filename)
 
-        model = self.copymodel(filename)
+            # copy the input WDM file built for the template
+
+            model.wdminfile = '{}_in.wdm'.format(filename)
+            shutil.copyfile(self._template_wdm, model.wdminfile)
                                          
-        # adjust the values of the parameters
+            # adjust the values of the parameters
 
-        for variable, adjustment in zip(self.variables, adjustments):
-            self.adjust(model, variable, adjustment)
+            for variable, adjustment in zip(self.variables, adjustments):
+                self.adjust(model, variable, adjustment)
 
-        # run and pass back the result
+            # run and pass back the result
                   
-        print('running', name, 'perturbation')
-        return self.run(model)
-
-    def perturb(self, 
-                parallel,
-                nprocessors,
-                timeout = 300,
-                verbose = True,
-                ):
+            print('running', name, 'perturbation')
+            return self.run(model)
+
+    def check_paths(self, variables, perturbations):
         """
-        Performs the perturbation analysis.
+        Makes sure the paths to the simulation files are short enough for 
+        HSPF, which only reads 64 characters of each path in the FILES block
+        of the UCI file. The longest path is for the output WDM file of the 
+        largest negative perturbation.
+        """
+
+        # the scratch directories have a one-character prefix and eight 
+        # random characters
+
+        if self.scratch_dir is None: 
+            directory = self.output
+        else:
+            directory = '{}/c{}'.format(self.scratch_dir, 8 * 'x')
+
+        names = (['{}{:4.3f}'.format('baseline', 0)] +
+                 ['{}{:4.3f}'.format(v, -max(perturbations) * 
+                                     self.get_default(v))
+                  for v in variables])
+
+        n = max(len('{}/{}_out.wdm'.format(directory, name)) for name in names)
+
+        if n > 64:
+
+            if self.scratch_dir is None: 
+                d, path = 'output directory', self.output
+            else:
+                d, path = 'scratch_dir', self.scratch_dir
+
+            print('error: the simulation file paths in {} '.format(path) +
+                  'are up to {} characters long, but HSPF '.format(n) +
+                  'only reads 64; use a shorter {}\n'.format(d))
+            raise ValueError
+
+    def perturb_both(self, 
+                     parallel,
+                     timeout = 300,
+                     verbose = True,
+                     ):
+        """
+        Performs the perturbation analysis in the positive and negative 
+        directions together and returns both lists of sensitivities. In 
+        parallel the simulations use the pool of workers opened by 
+        autocalibrate. The timeout (in seconds) applies to each round of 
+        simulations across the workers, so the batch is allowed the timeout 
+        times the number of simulations per worker.
         """
 
         if verbose:
@@ -291,36 +499,68 @@ class AutoCalibrator:
                 print('perturbing the model serially\n')
 
         # adjust the parameter values for each variable for each simulation
+        # in each direction (skipping variables found to be insensitive)
+
+        active = numpy.array(self._active, dtype = int)
+        rows   = numpy.arange(len(active))
+
+        increases = numpy.tile(self.values, (len(active), 1))
+        increases[rows, active] += self.perturbations[active]
 
-        its = range(len(self.variables)), self.variables, self.perturbations
-        adjustments = []
-        for i, v, p in zip(*its):
-            adjustment = self.values[:]
-            adjustment[i] += p
-            adjustments.append(adjustment)
+        decreases = numpy.tile(self.values, (len(active), 1))
+        decreases[rows, active] -= self.perturbations[active]
                                  
-        # run a baseline simulation and perturbation simulations for 
-        # each of calibration variables
+        # run a baseline simulation (unless the current values have already
+        # been simulated) and positive and negative perturbation simulations 
+        # for each of the sensitive calibration variables at the same time
 
-        its = self.variables, self.perturbations, adjustments
-        simulations = ([['baseline', 0, self.values]] + 
-                       [[v, p, a] for v, p, a in zip(*its)])
+        key = tuple(round(v, 6) for v in self.values)
+
+        perturbations = self.perturbations.tolist()
+
+        simulations = ([[self.variables[i], perturbations[i], a] 
+                        for i, a in zip(self._active, increases.tolist())] +
+                       [[self.variables[i], -perturbations[i], a] 
+                        for i, a in zip(self._active, decreases.tolist())])
+
+        if key not in self._baseline_cache:
+            simulations = [['baseline', 0, self.values.tolist()]] + simulations
 
         if parallel:
 
-            if nprocessors is None: n = cpu_count()
-            else:                   n = nprocessors
+            # the pool of workers is opened and closed by autocalibrate
+
+            if self._executor is None:
+                print('error: no pool of workers is open for the simulations')
+                raise RuntimeError
+
+            futures = {}
 
             try: 
 
-                # create a pool of workers and try parallel
+                # copy the adjustments to the shared matrix, send the rows
+                # to the pool of workers, and collect the results in the 
+                # order the simulations finish
 
-                with Pool(n, maxtasksperchild = 4 * cpu_count()) as p:
-                    results = p.map_async(self.simulate, simulations)
-                    optimizations = results.get(timeout = timeout)
+                for i, s in enumerate(simulations): 
+                    self._matrix[i] = s[2]
+                    futures[self._executor.submit(_simulate, 
+                                                  (i, s[0], s[1]))] = i
+
+                # allow the timeout for each round of simulations
+
+                rounds = -(-len(simulations) // self._nworkers)
+
+                optimizations = [None for s in simulations]
+                for future in as_completed(futures, timeout = timeout * rounds):
+                    optimizations[futures[future]] = future.result()
 
             except:
 
+                # cancel the simulations that have not started
+
+                for future in futures: future.cancel()
+
                 print('error: parallel calibration failed\n')
                 print('last values of calibration variables:\n')
                 for i in zip(self.variables, self.values): print(*i)
@@ -337,15 +577,102 @@ class AutoCalibrator:
             print('\ncompleted perturbation in ' +
                   '{:.1f} seconds\n'.format(time.time() - st))
 
-        # calculate the sensitivities for the perturbations
+        # add or save the baseline value of the optimization parameter
 
-        sensitivities = [o - optimizations[0] for o in optimizations[1:]]
+        if key in self._baseline_cache:
+            optimizations = [self._baseline_cache[key]] + optimizations
+        else:
+            self._baseline_cache[key] = optimizations[0]
+
+        # calculate the sensitivities for the perturbations (the skipped 
+        # variables have none)
+
+        n = len(active)
+
+        positives = [0 for v in self.variables]
+        negatives = [0 for v in self.variables]
+
+        its = self._active, optimizations[1:n+1], optimizations[n+1:]
+        for i, p, m in zip(*its):
+            positives[i] = p - optimizations[0]
+            negatives[i] = m - optimizations[0]
 
         # save the current value of the optimization parameter
 
         self.value = optimizations[0]
 
-        return sensitivities
+        return positives, negatives
+
+    def open_pool(self, nprocessors = None):
+        """
+        Starts a persistent pool of worker processes for the simulations.
+        Each worker receives a copy of the calibrator (including the 
+        pickled template model) once when it starts. The workers are forked
+        on Linux so they inherit the loaded modules and the template without
+        pickling (fork is unsafe on macOS, so other platforms use spawn).
+        """
+
+        if nprocessors is None: n = cpu_count()
+        else:                   n = nprocessors
+
+        self._nworkers = n
+
+        if sys.platform.startswith('linux'): context = get_context('fork')
+        else:                                context = get_context('spawn')
+
+        # shared matrix with enough rows for a baseline and a positive and
+        # negative perturbation of each variable
+
+        shape = 2 * len(self.variables) + 1, len(self.variables)
+
+        self._memory = SharedMemory(create = True, 
+                                    size = 8 * shape[0] * shape[1])
+        self._matrix = numpy.ndarray(shape, dtype = numpy.float64, 
+                                     buffer = self._memory.buf)
+
+        initargs = self, self._memory.name, shape
+
+        self._executor = ProcessPoolExecutor(max_workers = n,
+                                             mp_context = context,
+                                             initializer = _init_worker,
+                                             initargs = initargs)
+
+    def close_pool(self, terminate = False):
+        """
+        Shuts down the pool of worker processes and frees the shared memory.
+        If "terminate" is True (e.g., after a failure or timeout) the queued 
+        simulations are cancelled and the workers are stopped immediately
+        rather than waiting for the running simulations to finish.
+        """
+
+        if self._executor is not None and terminate:
+
+            # the executor has no public way to stop running tasks, so the
+            # worker processes are terminated directly; "_processes" is a 
+            # CPython implementation detail, so fall back to no processes (the
+            # shutdown below still cancels the queued simulations)
+
+            processes = getattr(self._executor, '_processes', None) or {}
+            processes = list(processes.values())
+
+            self._executor.shutdown(wait = False, cancel_futures = True)
+
+            for process in processes: process.terminate()
+            for process in processes: process.join()
+
+            self._executor = None
+
+        elif self._executor is not None:
+
+            self._executor.shutdown()
+            self._executor = None
+
+        if self._memory is not None:
+
+            self._matrix = None
+            self._memory.close()
+            self._memory.unlink()
+            self._memory = None
 
     def get_default(self, variable):
         """Gets the default value of the perturbation for the variable.
@@ -372,29 +699,29 @@ class AutoCalibrator:
         the calibrated values stay within the limits.
         """
 
-        for i in range(len(self.variables)):
+        mi = numpy.array([self.parameter_ranges[v][0] for v in self.variables])
+        ma = numpy.array([self.parameter_ranges[v][1] for v in self.variables])
 
-            variable = self.variables[i]
-            value    = self.values[i]
-            mi, ma   = self.parameter_ranges[variable]
-            
-            if value < mi:
-                its = variable, value, mi
-                print('warning: current value of ' +
-                      '{} ({}) is below minimum ({})'.format(*its))
-                self.values[i] = mi
-            if value > ma:
-                its = variable, value, ma
-                print('warning: current value of ' +
-                      '{} ({}) is above maximum ({})'.format(*its))
-                self.values[i] = ma
+        for i in numpy.flatnonzero(self.values < mi):
+            its = self.variables[i], self.values[i], mi[i]
+            print('warning: current value of ' +
+                  '{} ({}) is below minimum ({})'.format(*its))
+
+        for i in numpy.flatnonzero(self.values > ma):
+            its = self.variables[i], self.values[i], ma[i]
+            print('warning: current value of ' +
+                  '{} ({}) is above maximum ({})'.format(*its))
+
+        self.values = numpy.clip(self.values, mi, ma)
 
     def optimize(self, 
                  parallel, 
-                 nprocessors,
+                 tolerance = 0.00001,
                  ):
         """
-        Optimizes the objective function for the parameters.
+        Optimizes the objective function for the parameters. Variables with
+        sensitivities below the tolerance in both directions are skipped in
+        the subsequent iterations.
         """
 
         # set the current value of the optimization parameter
@@ -415,46 +742,45 @@ class AutoCalibrator:
 
             # set the current values of the calibration parameters
             
-            values = self.values[:]
+            values = self.values.copy()
 
             print('\ncurrent optimization value: {:4.3f}\n'.format(self.value))
 
-            # perturb the values positively
-
-            positives = self.perturb(parallel, nprocessors)
+            # perturb the values positively and negatively
 
-            # perturb the values negatively
+            positives, negatives = self.perturb_both(parallel)
 
-            self.perturbations = [-p for p in self.perturbations]
-            negatives = self.perturb(parallel, nprocessors)
+            # skip the insensitive variables in the next iteration
 
-            # reset the perturbations to positive
-
-            self.perturbations = [-p for p in self.perturbations]
+            self._active = [i for i in self._active
+                            if abs(positives[i]) > tolerance or
+                            abs(negatives[i]) > tolerance]
 
             # iterate through the calibration variables and update their
             # values positively or negatively if they increase the value
             # of the optimization parameter
 
-            for i in range(len(self.values)):
+            positives = numpy.array(positives)
+            negatives = numpy.array(negatives)
+
+            increase = (positives > 0) & (positives > negatives)
+            decrease = ~increase & (negatives > 0)
 
-                p = positives[i]
-                n = negatives[i]
-                d = self.perturbations[i]
+            for i in numpy.flatnonzero(increase | decrease):
 
-                # see if positive change increases optimization
+                if increase[i]: t, d = t1, positives[i]
+                else:           t, d = t2, negatives[i]
 
-                if p > 0 and p > n:
+                its = self.variables[i], self.perturbations[i]
+                print(t.format(*its, self.optimization, d))
 
-                    its = self.variables[i], d, self.optimization, p
-                    print(t1.format(*its))
-                    self.values[i] = round(self.values[i] + d, 3)
+            # update the values of the variables that improve the fit
 
-                elif n > 0:
+            changes = self.perturbations * (increase.astype(float) - decrease)
 
-                    its = self.variables[i], d, self.optimization, n
-                    print(t2.format(*its))
-                    self.values[i] = round(self.values[i] - d, 3)
+            self.values = numpy.where(increase | decrease,
+                                      numpy.round(self.values + changes, 3),
+                                      self.values)
 
             # make sure variables are within bounds
 
@@ -469,7 +795,7 @@ class AutoCalibrator:
         # since the last iteration made the fit worse, reset the values of 
         # the calibration parameters to the previous iteration
 
-        self.values = values[:]
+        self.values = values
 
     def autocalibrate(self, 
                       output,
@@ -492,6 +818,17 @@ class AutoCalibrator:
         values of the HSPF PERLND parameters contained in the vars list.
         """
 
+        # make sure the variables can be calibrated
+
+        for v in variables:
+            if v not in self._adjustments:
+                print('error: unknown calibration variable {}\n'.format(v))
+                raise ValueError
+
+        # make sure the simulation file paths will work with HSPF
+
+        self.check_paths(variables, perturbations)
+
         # open up the base model
 
         with open(self.hspfmodel, 'rb') as f: hspfmodel = pickle.load(f)
@@ -537,38 +874,100 @@ class AutoCalibrator:
             filepath = '{}/submodel'.format(self.output)
             self.create_submodel(filepath, self.comid)
 
-        # set up the current values of the variables, the amount to perturb
-        # them by in each iteration, and the optimization parameter
+        # open a template of the model to copy for each simulation (a 
+        # separate copy so the calibrated model saved below is not changed)
+
+        if self.submodel is None: m = self.hspfmodel
+        else:                     m = self.submodel
+
+        with open(m, 'rb') as f: template = pickle.load(f)
+
+        # build the input WDM file for the template once since only the land
+        # segment parameters change between the simulations (in a temporary
+        # directory that is removed after the calibration)
 
-        self.variables    = [v for v in variables]
-        self.values       = [variables[v] for v in variables]
-        self.optimization = optimization
+        directory = tempfile.mkdtemp(dir = self.scratch_dir)
 
-        # current value of the optimization parameter
+        try:
 
-        self.value = -10 
+            template.filename = '{}/template'.format(directory)
+            template.build_wdminfile()
+
+            # keep the pickled template in memory rather than reading it from 
+            # disk for every simulation (unpickling is faster than a deepcopy)
+
+            self._template_wdm    = template.wdminfile
+            protocol              = pickle.HIGHEST_PROTOCOL
+            self._hspfmodel_bytes = pickle.dumps(template, protocol = protocol)
+
+            # set up the current values of the variables, the amount to perturb
+            # them by in each iteration, and the optimization parameter
+
+            self.variables    = tuple(variables)
+            self.values       = numpy.array([variables[v] 
+                                             for v in self.variables],
+                                            dtype = numpy.float64)
+            self.optimization = optimization
+
+            # reset the baseline simulation results and observed flows from any
+            # previous calibration and process the observed flows before any
+            # workers are started
+
+            self._baseline_cache = {}
+            self._obs_cache      = None
+
+            self.get_observations()
+
+            # current value of the optimization parameter
+
+            self.value = -10 
+
+            # perturb until reaching a maximum (start with large perturbations)
+
+            print('attempting to calibrate {}'.format(self.hspfmodel))
+
+            # start the pool of workers once for all the perturbations
+
+            if parallel: self.open_pool(nprocessors)
+
+            for p in perturbations:
+                self.perturbations = numpy.array([p * self.get_default(v) 
+                                                  for v in self.variables])
+
+                # check all the variables again for the new perturbation
+
+                self._active = list(range(len(self.variables)))
+
+                self.optimize(parallel)
+
+        except:
+
+            # stop the workers right away if the calibration fails
+
+            self.close_pool(terminate = True)
+            raise
 
-        # perturb until reaching a maximum (start with large perturbations)
+        finally:
 
-        print('attempting to calibrate {}'.format(self.hspfmodel))
+            shutil.rmtree(directory)
 
-        for p in perturbations:
-            self.perturbations = [p * self.get_default(v) for v in variables]
-            self.optimize(parallel, nprocessors)
+        self.close_pool()
 
         print('\noptimization complete, saving model\n')
 
-        # set the submodel to None to save the full model
+        # set the submodel to None and use the full model opened above
 
         self.submodel = None
 
-        model = self.copymodel(output)
+        model = hspfmodel
+        model.filename = output
                                  
         # adjust the values of the parameters
 
-        for variable, adjustment in zip(self.variables, self.values):
+        for variable, adjustment in zip(self.variables, self.values.tolist()):
             self.adjust(model, variable, adjustment)
 
         # adjust the filename
 
-        with open(output, 'wb') as f: pickle.dump(model, f)
+        with open(output, 'wb') as f: 
+            pickle.dump(model, f, protocol = pickle.HIGHEST_PROTOCOL)